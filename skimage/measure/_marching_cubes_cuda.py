@@ -0,0 +1,354 @@
+"""CUDA backend of `marching_cubes`, for the algorithm of Lorensen et al.
+
+The cells are processed by two CUDA kernels, with one thread per cell. The
+first kernel determines the cube index of each cell and how many triangles
+it contributes. A cumulative sum over the cells then gives the location in
+the output of the triangles of each cell that is not empty, such that the
+second kernel can write them without synchronization between threads.
+
+The second kernel writes, for each corner of each triangle, a key that
+identifies the edge of the grid that the vertex lies on, together with the
+vertex position, its gradient and value. Triangles that share an edge share
+the vertex. These are merged afterwards, in the order in which the
+(serial) CPU implementation would have created them, so that the mesh is
+the same as the one of ``backend='cpu'``.
+
+This backend is experimental: it has only been checked against an emulation
+of the kernels with NumPy, and not yet on GPU hardware.
+"""
+
+import functools
+
+import numpy as np
+
+from ._marching_cubes_lewiner import (
+    EDGETORELATIVEPOSX,
+    EDGETORELATIVEPOSY,
+    EDGETORELATIVEPOSZ,
+    _load_mc_luts,
+)
+
+_BLOCK_SIZE = 256
+
+# The C types of the volumes that the kernel is compiled for
+_CTYPES = {
+    np.uint8: 'unsigned char',
+    np.int8: 'signed char',
+    np.uint16: 'unsigned short',
+    np.int16: 'short',
+    np.float32: 'float',
+    np.float64: 'double',
+}
+
+# The computations follow _marching_cubes_lewiner_cy.pyx, operation by
+# operation, so that the results are the same. Corners are numbered by
+# dz*4 + dy*2 + dx (the "vv" order), except for v0..v7 and the cube index.
+_SOURCE = r'''
+#define EPS 2.220446049250313e-16  // np.spacing(1.0)
+
+__device__ long long volume_index(int x, int y, int z, int nx, int ny) {
+    return ((long long)z * ny + y) * nx + x;
+}
+
+extern "C" __global__ void count_triangles(
+        const volume_t *im, const unsigned char *mask, int use_mask,
+        int single_mesh, const signed char *cases, double isovalue,
+        int nx, int ny, int st, int ncx, int ncy, long long n_cells,
+        unsigned char *indices, int *counts) {
+    long long cell = blockIdx.x * (long long)blockDim.x + threadIdx.x;
+    if (cell >= n_cells) return;
+    int x = (int)(cell % ncx) * st;
+    int y = (int)((cell / ncx) % ncy) * st;
+    int z = (int)(cell / ((long long)ncx * ncy)) * st;
+
+    counts[cell] = 0;
+    indices[cell] = 0;
+    if (use_mask && !mask[volume_index(x + st, y + st, z + st, nx, ny)]) return;
+
+    double vv[8];
+    int all_valid = 1;
+    for (int c = 0; c < 8; c++) {
+        float value = (float)im[volume_index(x + (c & 1) * st, y + ((c >> 1) & 1) * st,
+                                             z + (c >> 2) * st, nx, ny)];
+        all_valid &= value > -1;
+        vv[c] = (double)value - isovalue;
+    }
+    if (single_mesh && !all_valid) return;
+
+    // The bits of the cube index are in the order v0..v7
+    int index = (vv[0] > 0.0) | (vv[1] > 0.0) << 1 | (vv[3] > 0.0) << 2 |
+                (vv[2] > 0.0) << 3 | (vv[4] > 0.0) << 4 | (vv[5] > 0.0) << 5 |
+                (vv[7] > 0.0) << 6 | (vv[6] > 0.0) << 7;
+    if (index == 0 || index == 255) return;
+
+    int nt = 0;
+    while (cases[index * 16 + 3 * nt] != -1) nt++;
+    indices[cell] = (unsigned char)index;
+    counts[cell] = 3 * nt;
+}
+
+extern "C" __global__ void emit_triangles(
+        const volume_t *im, const signed char *cases,
+        const signed char *edges, double isovalue,
+        int nx, int ny, int st, int ncx, int ncy,
+        const long long *cells, const unsigned char *indices,
+        const long long *offsets, long long n_active,
+        int ox, int oy, int oz, double sx, double sy, double sz,
+        long long *keys, float *positions, float *gradients, float *values) {
+    long long a = blockIdx.x * (long long)blockDim.x + threadIdx.x;
+    if (a >= n_active) return;
+    long long cell = cells[a];
+    int x = (int)(cell % ncx) * st;
+    int y = (int)((cell / ncx) % ncy) * st;
+    int z = (int)(cell / ((long long)ncx * ncy)) * st;
+    int index = indices[cell];
+    double stp = (double)st;
+
+    // Corner values, max value, strengths and gradients, as in
+    // Cell.set_cube and Cell.prepare_for_adding_triangles
+    double vv[8], vs[8], vg[24];
+    double vmin = 0.0, vmax = 0.0;
+    for (int c = 0; c < 8; c++) {
+        vv[c] = (double)(float)im[volume_index(x + (c & 1) * st, y + ((c >> 1) & 1) * st,
+                                               z + (c >> 2) * st, nx, ny)] - isovalue;
+        if (vv[c] > vmax) vmax = vv[c];
+        if (vv[c] < vmin) vmin = vv[c];
+        vs[c] = 1.0 / (EPS + fabs(vv[c]));
+    }
+    vmax = vmax - vmin;
+    double v0 = vv[0], v1 = vv[1], v2 = vv[3], v3 = vv[2];
+    double v4 = vv[4], v5 = vv[5], v6 = vv[7], v7 = vv[6];
+    double g[24] = {
+        v0 - v1, v0 - v3, v0 - v4,  v0 - v1, v1 - v2, v1 - v5,
+        v3 - v2, v1 - v2, v2 - v6,  v3 - v2, v0 - v3, v3 - v7,
+        v4 - v5, v4 - v7, v0 - v4,  v4 - v5, v5 - v6, v1 - v5,
+        v7 - v6, v5 - v6, v2 - v6,  v7 - v6, v4 - v7, v3 - v7};
+    for (int c = 0; c < 24; c++) vg[c] = g[c];
+
+    long long n = offsets[a];
+    for (int k = 0; k < 16 && cases[index * 16 + k] != -1; k++, n++) {
+        int vi = cases[index * 16 + k];
+        int dx1 = edges[vi * 2], dx2 = edges[vi * 2 + 1];
+        int dy1 = edges[24 + vi * 2], dy2 = edges[24 + vi * 2 + 1];
+        int dz1 = edges[48 + vi * 2], dz2 = edges[48 + vi * 2 + 1];
+        int index1 = dz1 * 4 + dy1 * 2 + dx1;
+        int index2 = dz2 * 4 + dy2 * 2 + dx2;
+        double tmpf1 = vs[index1], tmpf2 = vs[index2];
+
+        // The edge is identified by its lower end point and its direction
+        int direction = dx1 != dx2 ? 0 : (dy1 != dy2 ? 1 : 2);
+        keys[n] = volume_index(x + (dx1 < dx2 ? dx1 : dx2) * st,
+                               y + (dy1 < dy2 ? dy1 : dy2) * st,
+                               z + (dz1 < dz2 ? dz1 : dz2) * st, nx, ny) * 3
+                  + direction;
+
+        double fx = 0.0, fy = 0.0, fz = 0.0, ff = 0.0;
+        fx += (double)dx1 * tmpf1; fy += (double)dy1 * tmpf1;
+        fz += (double)dz1 * tmpf1; ff += tmpf1;
+        fx += (double)dx2 * tmpf2; fy += (double)dy2 * tmpf2;
+        fz += (double)dz2 * tmpf2; ff += tmpf2;
+        float px = (float)((double)(x + ox) + stp * fx / ff);
+        float py = (float)((double)(y + oy) + stp * fy / ff);
+        float pz = (float)((double)(z + oz) + stp * fz / ff);
+        positions[n * 3 + 0] = (float)((double)pz * sz);
+        positions[n * 3 + 1] = (float)((double)py * sy);
+        positions[n * 3 + 2] = (float)((double)px * sx);
+
+        float s1 = (float)tmpf1, s2 = (float)tmpf2;
+        for (int j = 0; j < 3; j++) {
+            gradients[n * 3 + 2 - j] = (float)(vg[index1 * 3 + j] * s1) +
+                                       (float)(vg[index2 * 3 + j] * s2);
+        }
+        values[n] = (float)vmax;
+    }
+}
+'''
+
+
+@functools.cache
+def _get_kernels(ctype):
+    """Compile the kernels for volumes of the given C type, only once."""
+    import cupy as cp
+
+    module = cp.RawModule(
+        code=f'typedef {ctype} volume_t;\n' + _SOURCE,
+        # Avoid contracting multiplications and additions, which would
+        # change the rounding compared to the CPU implementation
+        options=('--fmad=false',),
+    )
+    return module.get_function('count_triangles'), module.get_function('emit_triangles')
+
+
+@functools.cache
+def _get_tables():
+    """Read the case and edge tables and upload them to the device, only once."""
+    import cupy as cp
+
+    cases = cp.asarray(np.ascontiguousarray(_load_mc_luts()['CASESCLASSIC']))
+    edges = cp.asarray(
+        np.concatenate(
+            [
+                EDGETORELATIVEPOSX.ravel(),
+                EDGETORELATIVEPOSY.ravel(),
+                EDGETORELATIVEPOSZ.ravel(),
+            ]
+        )
+    )
+    return cases, edges
+
+
+def _empty_result():
+    return (
+        np.empty((0, 3), np.float32),
+        np.empty((0, 3), np.int32),
+        np.empty((0, 3), np.float32),
+        np.empty((0,), np.float32),
+    )
+
+
+def _launch(kernel, n, args):
+    blocks = (int(n) + _BLOCK_SIZE - 1) // _BLOCK_SIZE
+    kernel((blocks,), (_BLOCK_SIZE,), args)
+
+
+def marching_cubes_cuda(
+    volume, level, step_size, mask, single_mesh, descent, spacing, origin
+):
+    """Apply marching cubes (Lorensen et al.) to `volume` on the GPU.
+
+    The arguments are those of the CPU kernel, and are assumed to be
+    validated already. Arrays are taken from and returned to the host.
+    """
+    try:
+        import cupy as cp
+        import cupyx
+    except ImportError:
+        raise ImportError(
+            "CuPy is not installed. Please ensure it is installed in order "
+            "to use marching_cubes with backend='cuda'."
+        )
+
+    ctype = _CTYPES[volume.dtype.type]
+    count_triangles, emit_triangles = _get_kernels(ctype)
+
+    nz, ny, nx = volume.shape
+    st = step_size
+    ncz, ncy, ncx = (nz - 1) // st, (ny - 1) // st, (nx - 1) // st
+    n_cells = ncz * ncy * ncx
+    if n_cells == 0:
+        return _empty_result()
+
+    im = cp.asarray(np.ascontiguousarray(volume))
+    use_mask = mask is not None
+    if use_mask:
+        mask_gpu = cp.asarray(np.ascontiguousarray(mask, dtype=bool)).view(cp.uint8)
+    else:
+        mask_gpu = cp.zeros(1, dtype=cp.uint8)
+    cases, edges = _get_tables()
+
+    # Count the triangles of each cell, and obtain the location of the
+    # output of each non-empty cell
+    indices = cp.empty(n_cells, dtype=cp.uint8)
+    counts = cp.empty(n_cells, dtype=cp.int32)
+    _launch(
+        count_triangles,
+        n_cells,
+        (
+            im,
+            mask_gpu,
+            np.int32(use_mask),
+            np.int32(single_mesh),
+            cases,
+            np.float64(level),
+            np.int32(nx),
+            np.int32(ny),
+            np.int32(st),
+            np.int32(ncx),
+            np.int32(ncy),
+            np.int64(n_cells),
+            indices,
+            counts,
+        ),
+    )
+    cells = cp.flatnonzero(counts).astype(cp.int64)
+    active_counts = counts[cells].astype(cp.int64)
+    n_refs = int(active_counts.sum())
+    if n_refs == 0:
+        return _empty_result()
+    offsets = cp.cumsum(active_counts) - active_counts
+
+    # Write the vertices of all triangles
+    keys = cp.empty(n_refs, dtype=cp.int64)
+    positions = cp.empty((n_refs, 3), dtype=cp.float32)
+    gradients = cp.empty((n_refs, 3), dtype=cp.float32)
+    ref_values = cp.empty(n_refs, dtype=cp.float32)
+    oz, oy, ox = origin
+    sz, sy, sx = spacing
+    _launch(
+        emit_triangles,
+        len(cells),
+        (
+            im,
+            cases,
+            edges,
+            np.float64(level),
+            np.int32(nx),
+            np.int32(ny),
+            np.int32(st),
+            np.int32(ncx),
+            np.int32(ncy),
+            cells,
+            indices,
+            offsets,
+            np.int64(len(cells)),
+            np.int32(ox),
+            np.int32(oy),
+            np.int32(oz),
+            np.float64(sx),
+            np.float64(sy),
+            np.float64(sz),
+            keys,
+            positions,
+            gradients,
+            ref_values,
+        ),
+    )
+
+    # Merge the vertices on the same edge, numbering them in the order in
+    # which they are first referred to. Sorting by key and then by reference
+    # gives the first reference to each vertex at the start of its group.
+    by_key = cp.lexsort(cp.stack([cp.arange(n_refs, dtype=cp.int64), keys]))
+    sorted_keys = keys[by_key]
+    is_first = cp.empty(n_refs, dtype=bool)
+    is_first[0] = True
+    is_first[1:] = sorted_keys[1:] != sorted_keys[:-1]
+    first = by_key[is_first]
+    n_vertices = len(first)
+    inverse = cp.empty(n_refs, dtype=cp.int64)
+    inverse[by_key] = cp.cumsum(is_first) - 1
+    order = cp.argsort(first)
+    rank = cp.empty(n_vertices, dtype=cp.int64)
+    rank[order] = cp.arange(n_vertices, dtype=cp.int64)
+    vertex_of_ref = rank[inverse]
+
+    vertices = positions[first[order]]
+    normals = cp.zeros((n_vertices, 3), dtype=cp.float32)
+    cupyx.scatter_add(normals, vertex_of_ref, gradients)
+    values = cp.zeros(n_vertices, dtype=cp.float32)
+    cupyx.scatter_max(values, vertex_of_ref, ref_values)
+
+    # Normalize the normals, as in Cell.get_normals
+    lengths = cp.sqrt((normals.astype(cp.float64) ** 2).sum(axis=1))
+    scale = cp.where(lengths > 0, 1.0 / lengths, 0.0)
+    normals = (normals * scale[:, None]).astype(cp.float32)
+
+    faces = vertex_of_ref.astype(cp.int32).reshape(-1, 3)
+    if descent:
+        faces = faces[:, ::-1]
+
+    return (
+        cp.asnumpy(vertices),
+        np.ascontiguousarray(cp.asnumpy(faces)),
+        cp.asnumpy(normals),
+        cp.asnumpy(values),
+    )
@@ -1,10 +1,20 @@
-import base64
+import functools
+import math
+import os
 
 import numpy as np
 
-from . import _marching_cubes_lewiner_luts as mcluts
 from . import _marching_cubes_lewiner_cy
 
+# Decoded lookup tables, see tools/precompute/_precompute_mc_luts.py
+_MC_LUTS_PATH = os.path.join(
+    os.path.dirname(__file__), '_marching_cubes_lewiner_luts.npz'
+)
+
+# Volumes of these types are passed to the kernel as is, others are cast
+# to float32
+_VOLUME_DTYPES = (np.uint8, np.int8, np.uint16, np.int16, np.float32, np.float64)
+
 
 def marching_cubes(
     volume,
@@ -16,7 +26,9 @@ def marching_cubes(
     allow_degenerate=True,
     method='lewiner',
     mask=None,
-    single_mesh=False
+    single_mesh=False,
+    num_threads=None,
+    backend='cpu',
 ):
     """Marching cubes algorithm to find surfaces in 3d volumetric data.
 
@@ -28,8 +40,10 @@ def marching_cubes(
     Parameters
     ----------
     volume : (M, N, P) ndarray
-        Input data volume to find isosurfaces. Will internally be
-        converted to float32 if necessary.
+        Input data volume to find isosurfaces. Its values are used with
+        float32 precision. Volumes of type float32, float64, or a (signed
+        or unsigned) 8 or 16-bit integer or boolean type are read without a
+        copy, others are internally converted to float32.
     level : float, optional
         Contour value to search for isosurfaces in `volume`. If not
         given or None, the average of the min and max of vol is used.
@@ -59,14 +73,31 @@ def marching_cubes(
         are located within certain region of the volume M, N, P-e.g. the top
         half of the cube-and also allow to compute finite surfaces-i.e. open
         surfaces that do not end at the border of the cube.
+    num_threads : int, optional
+        The number of threads to use. The volume is divided into as many
+        slabs along its first axis, which are processed in parallel. If
+        ``None``, use the OpenMP default value; this is 1 if scikit-image
+        was built without OpenMP support, in which case the slabs are
+        processed one after the other. The result does not depend on
+        the number of threads, up to floating point rounding of the normals.
+        Not used by the 'cuda' backend.
+    backend : {'cpu', 'cuda'}, optional
+        Whether the surface is computed on the CPU (the default), or on a
+        CUDA capable GPU, which requires CuPy. The 'cuda' backend is
+        experimental: it has not been tested on GPU hardware yet, and may
+        change or be removed without deprecation. It only supports
+        ``method='lorensen'``, and is meant to give the same mesh as the
+        'cpu' backend, up to floating point rounding of the normals.
 
     Returns
     -------
-    verts : (V, 3) array
+    verts : (V, 3) array of float32
         Spatial coordinates for V unique mesh vertices. Coordinate order
-        matches input `volume` (M, N, P). If ``allow_degenerate`` is set to
-        True, then the presence of degenerate triangles in the mesh can make
-        this array have duplicate vertices.
+        matches input `volume` (M, N, P). The coordinates are scaled by
+        `spacing` before they are rounded to float32, for any `spacing`.
+        If ``allow_degenerate`` is set to True, then the presence of
+        degenerate triangles in the mesh can make this array have duplicate
+        vertices.
     faces : (F, 3) array
         Define triangular faces via referencing vertex indices from ``verts``.
         This algorithm specifically outputs triangles, so each face has
@@ -137,6 +168,10 @@ def marching_cubes(
         use_classic = True
     elif method != 'lewiner':
         raise ValueError("method should be either 'lewiner' or 'lorensen'")
+    if backend not in ('cpu', 'cuda'):
+        raise ValueError("backend should be either 'cpu' or 'cuda'")
+    if backend == 'cuda' and not use_classic:
+        raise ValueError("backend='cuda' is only available for method='lorensen'")
     return _marching_cubes_lewiner(
         volume,
         level,
@@ -145,8 +180,10 @@ def marching_cubes(
         step_size,
         allow_degenerate,
         use_classic=use_classic,
-        mask=mask, 
+        mask=mask,
         single_mesh=single_mesh,
+        num_threads=num_threads,
+        backend=backend,
     )
 
 
@@ -160,6 +197,8 @@ def _marching_cubes_lewiner(
     use_classic,
     mask,
     single_mesh,
+    num_threads,
+    backend,
 ):
     """Lewiner et al. algorithm for marching cubes. See
     marching_cubes_lewiner for documentation.
@@ -171,75 +210,171 @@ def _marching_cubes_lewiner(
         raise ValueError('Input volume should be a 3D numpy array.')
     if volume.shape[0] < 2 or volume.shape[1] < 2 or volume.shape[2] < 2:
         raise ValueError("Input array must be at least 2x2x2.")
-    volume = np.ascontiguousarray(volume, np.float32)  # no copy if not necessary
+    # The algorithm reads float32, float64 and small integer data directly
+    if volume.dtype == bool:
+        volume = volume.view(np.uint8)
+    if volume.dtype not in _VOLUME_DTYPES:
+        volume = np.ascontiguousarray(volume, np.float32)
+    elif not volume.flags.c_contiguous:
+        volume = np.ascontiguousarray(volume)
 
     # Check/convert other inputs:
     # level
+    vmin, vmax = _minmax(volume)
+    # Same as for the volume cast to float32 (and without overflow)
+    vmin, vmax = np.float32(vmin), np.float32(vmax)
     if level is None:
-        level = 0.5 * (volume.min() + volume.max())
+        level = 0.5 * (vmin + vmax)
     else:
         level = float(level)
-        if level < volume.min() or level > volume.max():
+        if level < vmin or level > vmax:
             raise ValueError("Surface level must be within volume data range.")
     # spacing
     if len(spacing) != 3:
         raise ValueError("`spacing` must consist of three floats.")
+    spacing = tuple(float(s) for s in spacing)
     # step_size
     step_size = int(step_size)
     if step_size < 1:
         raise ValueError('step_size must be at least one.')
-    # use_classic
+    # gradient_direction
+    if gradient_direction not in ('descent', 'ascent'):
+        raise ValueError(
+            f"Incorrect input {gradient_direction} in `gradient_direction`, "
+            "see docstring."
+        )
+    # MC implementation is right-handed, but gradient_direction is
+    # left-handed
+    descent = gradient_direction == 'descent'
+    # use_classic and single_mesh, converted once to the C booleans that the
+    # kernel takes
     use_classic = bool(use_classic)
-    # extact single mesh
     single_mesh = bool(single_mesh)
-    # Get LutProvider class (reuse if possible)
-    L = _get_mc_luts()
+    # num_threads
+    if num_threads is None:
+        num_threads = 0
 
     # Check if a mask array is passed
     if mask is not None:
         if not mask.shape == volume.shape:
             raise ValueError('volume and mask must have the same shape.')
 
-    # Apply algorithm
-    func = _marching_cubes_lewiner_cy.marching_cubes
-    vertices, faces, normals, values = func(
-        volume, level, L, step_size, use_classic, mask, single_mesh
+    return _marching_cubes_unchecked(
+        volume,
+        level,
+        spacing,
+        descent,
+        step_size,
+        allow_degenerate,
+        use_classic,
+        mask,
+        single_mesh,
+        num_threads,
+        backend,
     )
 
-    if not len(vertices):
-        raise RuntimeError('No surface found at the given iso value.')
 
-    # Output in z-y-x order, as is common in skimage
-    vertices = np.fliplr(vertices)
-    normals = np.fliplr(normals)
-
-    # Finishing touches to output
-    faces.shape = -1, 3
-    if gradient_direction == 'descent':
-        # MC implementation is right-handed, but gradient_direction is
-        # left-handed
-        faces = np.fliplr(faces)
-    elif not gradient_direction == 'ascent':
-        raise ValueError(
-            f"Incorrect input {gradient_direction} in `gradient_direction`, "
-            "see docstring."
+def _marching_cubes_unchecked(
+    volume,
+    level,
+    spacing,
+    descent,
+    step_size,
+    allow_degenerate,
+    use_classic,
+    mask,
+    single_mesh,
+    num_threads,
+    backend,
+):
+    """Marching cubes for inputs that are already checked and converted.
+
+    This is the part of `marching_cubes` after the validation of its inputs,
+    for callers that apply it many times to volumes that are known to be
+    valid, e.g. to the frames of a time series. `volume` must be a C-contiguous
+    array of one of `_VOLUME_DTYPES` (of at least 2x2x2), `level` a float in
+    its range, `spacing` a tuple of three floats, `step_size` and
+    `num_threads` (0 for the default) integers, `descent`, `use_classic` and
+    `single_mesh` booleans, and `mask` None or an array with the shape of
+    `volume`.
+    """
+    # Get LutProvider class (reuse if possible)
+    L = _get_mc_luts()
+
+    origin = (0, 0, 0)
+    if mask is not None:
+        # Only visit the cells in the bounding box of the mask
+        bbox = _mask_bounding_box(mask, step_size)
+        if bbox is None:
+            raise RuntimeError('No surface found at the given iso value.')
+        volume, mask = volume[bbox], mask[bbox]
+        origin = tuple(slc.start for slc in bbox)
+
+    # Apply algorithm
+    if backend == 'cuda':
+        from ._marching_cubes_cuda import marching_cubes_cuda
+
+        vertices, faces, normals, values = marching_cubes_cuda(
+            volume, level, step_size, mask, single_mesh, descent, spacing, origin
+        )
+    else:
+        func = _marching_cubes_lewiner_cy.marching_cubes
+        vertices, faces, normals, values = func(
+            volume,
+            level,
+            L,
+            step_size,
+            use_classic,
+            mask,
+            single_mesh,
+            descent,
+            spacing,
+            origin,
+            num_threads,
         )
-    if not np.array_equal(spacing, (1, 1, 1)):
-        vertices = vertices * np.r_[spacing]
+
+    if not len(vertices):
+        raise RuntimeError('No surface found at the given iso value.')
 
     if allow_degenerate:
         return vertices, faces, normals, values
     else:
         fun = _marching_cubes_lewiner_cy.remove_degenerate_faces
-        return fun(vertices.astype(np.float32), faces, normals, values)
+        return fun(vertices, faces, normals, values)
+
 
+def _mask_bounding_box(mask, step_size):
+    """Return the slices of the part of `mask` that selects cells, or None.
 
-def _to_array(args):
-    shape, text = args
-    byts = base64.decodebytes(text.encode('utf-8'))
-    ar = np.frombuffer(byts, dtype='int8')
-    ar.shape = shape
-    return ar
+    A cell is visited if `mask` is set at its corner with the highest
+    indices. The box therefore starts at the cell before the first set
+    element, rounded down to a multiple of `step_size` so that the cells
+    in the box are the same as in the whole volume.
+    """
+    yx = mask.any(axis=0)
+    bbox = []
+    for selected in (mask.any(axis=(1, 2)), yx.any(axis=1), yx.any(axis=0)):
+        (indices,) = np.nonzero(selected)
+        if len(indices) == 0:
+            return None
+        start = max(indices[0] - 1, 0) // step_size * step_size
+        bbox.append(slice(int(start), int(indices[-1]) + 1))
+    return tuple(bbox)
+
+
+def _minmax(volume, chunk_size=2**18):
+    """Return the minimum and maximum of `volume` in a single pass.
+
+    Both reductions are applied to one chunk while it is still in cache, so
+    that the volume is read from memory only once.
+    """
+    flat = volume.reshape(-1)
+    vmin = vmax = flat[0]
+    for start in range(0, flat.size, chunk_size):
+        chunk = flat[start : start + chunk_size]
+        vmin = np.minimum(vmin, chunk.min())
+        vmax = np.maximum(vmax, chunk.max())
+    return vmin, vmax
 
 
 # Map an edge-index to two relative pixel positions. The edge index
@@ -256,64 +391,82 @@ EDGETORELATIVEPOSZ = np.array([ [0,0],[0,0],[0,0],[0,0], [1,1],[1,1],[1,1],[1,1]
 # fmt: on
 
 
-def _get_mc_luts():
-    """Kind of lazy obtaining of the luts."""
-    if not hasattr(mcluts, 'THE_LUTS'):
-        mcluts.THE_LUTS = _marching_cubes_lewiner_cy.LutProvider(
-            EDGETORELATIVEPOSX,
-            EDGETORELATIVEPOSY,
-            EDGETORELATIVEPOSZ,
-            _to_array(mcluts.CASESCLASSIC),
-            _to_array(mcluts.CASES),
-            _to_array(mcluts.TILING1),
-            _to_array(mcluts.TILING2),
-            _to_array(mcluts.TILING3_1),
-            _to_array(mcluts.TILING3_2),
-            _to_array(mcluts.TILING4_1),
-            _to_array(mcluts.TILING4_2),
-            _to_array(mcluts.TILING5),
-            _to_array(mcluts.TILING6_1_1),
-            _to_array(mcluts.TILING6_1_2),
-            _to_array(mcluts.TILING6_2),
-            _to_array(mcluts.TILING7_1),
-            _to_array(mcluts.TILING7_2),
-            _to_array(mcluts.TILING7_3),
-            _to_array(mcluts.TILING7_4_1),
-            _to_array(mcluts.TILING7_4_2),
-            _to_array(mcluts.TILING8),
-            _to_array(mcluts.TILING9),
-            _to_array(mcluts.TILING10_1_1),
-            _to_array(mcluts.TILING10_1_1_),
-            _to_array(mcluts.TILING10_1_2),
-            _to_array(mcluts.TILING10_2),
-            _to_array(mcluts.TILING10_2_),
-            _to_array(mcluts.TILING11),
-            _to_array(mcluts.TILING12_1_1),
-            _to_array(mcluts.TILING12_1_1_),
-            _to_array(mcluts.TILING12_1_2),
-            _to_array(mcluts.TILING12_2),
-            _to_array(mcluts.TILING12_2_),
-            _to_array(mcluts.TILING13_1),
-            _to_array(mcluts.TILING13_1_),
-            _to_array(mcluts.TILING13_2),
-            _to_array(mcluts.TILING13_2_),
-            _to_array(mcluts.TILING13_3),
-            _to_array(mcluts.TILING13_3_),
-            _to_array(mcluts.TILING13_4),
-            _to_array(mcluts.TILING13_5_1),
-            _to_array(mcluts.TILING13_5_2),
-            _to_array(mcluts.TILING14),
-            _to_array(mcluts.TEST3),
-            _to_array(mcluts.TEST4),
-            _to_array(mcluts.TEST6),
-            _to_array(mcluts.TEST7),
-            _to_array(mcluts.TEST10),
-            _to_array(mcluts.TEST12),
-            _to_array(mcluts.TEST13),
-            _to_array(mcluts.SUBCONFIG13),
-        )
+def _load_mc_luts():
+    """Read the decoded luts.
 
-    return mcluts.THE_LUTS
+    The luts are stored back to back in a single array, which is read at
+    once and split into views, rather than stored and read one by one.
+    """
+    with np.load(_MC_LUTS_PATH) as f:
+        data, names, shapes = f['data'], f['names'], f['shapes']
+    luts = {}
+    start = 0
+    for name, shape in zip(names, shapes):
+        # Shapes are padded with zeros to three dimensions
+        shape = tuple(int(n) for n in shape if n)
+        size = math.prod(shape)
+        luts[str(name)] = data[start : start + size].reshape(shape)
+        start += size
+    return luts
+
+
+@functools.cache
+def _get_mc_luts():
+    """Lazily obtain the luts, building them only once."""
+    luts = _load_mc_luts()
+    return _marching_cubes_lewiner_cy.LutProvider(
+        EDGETORELATIVEPOSX,
+        EDGETORELATIVEPOSY,
+        EDGETORELATIVEPOSZ,
+        luts['CASESCLASSIC'],
+        luts['CASES'],
+        luts['TILING1'],
+        luts['TILING2'],
+        luts['TILING3_1'],
+        luts['TILING3_2'],
+        luts['TILING4_1'],
+        luts['TILING4_2'],
+        luts['TILING5'],
+        luts['TILING6_1_1'],
+        luts['TILING6_1_2'],
+        luts['TILING6_2'],
+        luts['TILING7_1'],
+        luts['TILING7_2'],
+        luts['TILING7_3'],
+        luts['TILING7_4_1'],
+        luts['TILING7_4_2'],
+        luts['TILING8'],
+        luts['TILING9'],
+        luts['TILING10_1_1'],
+        luts['TILING10_1_1_'],
+        luts['TILING10_1_2'],
+        luts['TILING10_2'],
+        luts['TILING10_2_'],
+        luts['TILING11'],
+        luts['TILING12_1_1'],
+        luts['TILING12_1_1_'],
+        luts['TILING12_1_2'],
+        luts['TILING12_2'],
+        luts['TILING12_2_'],
+        luts['TILING13_1'],
+        luts['TILING13_1_'],
+        luts['TILING13_2'],
+        luts['TILING13_2_'],
+        luts['TILING13_3'],
+        luts['TILING13_3_'],
+        luts['TILING13_4'],
+        luts['TILING13_5_1'],
+        luts['TILING13_5_2'],
+        luts['TILING14'],
+        luts['TEST3'],
+        luts['TEST4'],
+        luts['TEST6'],
+        luts['TEST7'],
+        luts['TEST10'],
+        luts['TEST12'],
+        luts['TEST13'],
+        luts['SUBCONFIG13'],
+    )
 
 
 def mesh_surface_area(verts, faces):
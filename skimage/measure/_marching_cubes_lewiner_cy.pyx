@@ -24,19 +24,69 @@ import numpy as np
 cimport numpy as cnp
 cnp.import_array()
 
+from .._shared.fused_numerics cimport np_floats
+
+# Types of volumes that are read directly. The integer types are small
+# enough to be represented exactly by float32, such that the results are
+# the same as for the volume cast to float32, while only a quarter or half
+# of the memory is read.
+ctypedef fused volume_t:
+    cnp.uint8_t
+    cnp.int8_t
+    cnp.uint16_t
+    cnp.int16_t
+    np_floats
+
 # Enable low level memory management
-from libc.stdlib cimport malloc, free
+from libc.stdlib cimport malloc, realloc, free
+from libc.string cimport memset
+from cpython.pycapsule cimport PyCapsule_New, PyCapsule_GetPointer
+from cpython.ref cimport PyObject
+from cython.parallel cimport prange
+
+# Number of threads used by default, which is 1 if OpenMP is not available
+cdef extern from *:
+    """
+    #ifdef _OPENMP
+    #include <omp.h>
+    #define MC_MAX_THREADS() omp_get_max_threads()
+    #else
+    #define MC_MAX_THREADS() 1
+    #endif
+    """
+    int MC_MAX_THREADS() noexcept nogil
 
 # Define tiny winy number
 cdef cnp.float64_t FLT_EPSILON = np.spacing(1.0) #0.0000001
 
 # Define abs function for doubles
-cdef inline cnp.float64_t dabs(cnp.float64_t a) noexcept: return a if a>=0 else -a
-cdef inline int imin(int a, int b) noexcept: return a if a<b else b
+cdef inline cnp.float64_t dabs(cnp.float64_t a) noexcept nogil: return a if a>=0 else -a
+cdef inline int imin(int a, int b) noexcept nogil: return a if a<b else b
 
 # todo: allow dynamic isovalue?
 # todo: can we disable Cython from checking for zero division? Sometimes we know that it never happens!
 
+cdef void _free_capsule_pointer(object capsule) noexcept:
+    free(PyCapsule_GetPointer(capsule, NULL))
+
+
+cdef object take_buffer(void **data, size_t nbytes, int ndim,
+                        cnp.npy_intp *shape, int typenum):
+    """ Wrap the malloc'ed buffer at data[0], trimmed to nbytes, in a numpy
+    array without copying it. The array takes ownership of the buffer, and
+    NULL is stored in data[0].
+    """
+    if nbytes == 0:
+        return cnp.PyArray_SimpleNew(ndim, shape, typenum)
+    cdef void *trimmed = realloc(data[0], nbytes)
+    if trimmed is not NULL:
+        data[0] = trimmed
+    arr = cnp.PyArray_SimpleNewFromData(ndim, shape, typenum, data[0])
+    cnp.set_array_base(arr, PyCapsule_New(data[0], NULL, &_free_capsule_pointer))
+    data[0] = NULL
+    return arr
+
+
 def remove_degenerate_faces(vertices, faces, *arrays):
 
     vertices_map0 = np.arange(len(vertices), dtype=np.int32)
@@ -93,12 +143,15 @@ cdef class Cell:
     -----------------
     The vertices are stored in a C-array that is increased in size with
     factors of two if needed. The same applies to the faces and normals.
+    When the results are obtained, these arrays are handed over to numpy
+    without copying them.
+    Vertices and normals are stored in z-y-x order, as is common in skimage.
 
     Notes on faces
     --------------
     To keep track of the vertices already defined, this class maintains
     two faceLayer arrays. faceLayer1 is of the current layer (z-value)
-    and faceLayer2 is of the next. Both face layers have 4 elements per
+    and faceLayer2 is of the next. Both face layers have 3 elements per
     cell in that layer, 1 for each unique edge per cell (see
     get_index_in_facelayer). These are initialized as -1, and set to the
     index in the vertex array when a new vertex is created.
@@ -137,9 +190,10 @@ cdef class Cell:
     cdef cnp.float64_t v7
 
     # Small arrays to store the above values in (allowing indexing)
-    # and also the gradient at these points
+    # and also the gradient and interpolation strength at these points
     cdef cnp.float64_t *vv
     cdef cnp.float64_t *vg
+    cdef cnp.float64_t *vs
 
     # Max value of the eight corners
     cdef cnp.float64_t vmax
@@ -153,6 +207,7 @@ cdef class Cell:
     cdef cnp.float64_t v12_yg
     cdef cnp.float64_t v12_zg
     cdef int v12_calculated # a boolean
+    cdef int v12_index # Index in the vertex array, -1 if not yet added
 
     # The index value, our magic 256 bit word
     cdef int index
@@ -162,6 +217,16 @@ cdef class Cell:
     cdef int ny
     cdef int nz
 
+    # Voxel spacing, applied to the vertices when they are stored
+    cdef cnp.float64_t sx
+    cdef cnp.float64_t sy
+    cdef cnp.float64_t sz
+
+    # Location of the volume in a larger volume, added to the vertices
+    cdef int ox
+    cdef int oy
+    cdef int oz
+
     # Arrays with face information
     cdef int *faceLayer # The current facelayer (reference-copy of one of the below)
     cdef int *faceLayer1 # The actual first face layer
@@ -180,22 +245,26 @@ cdef class Cell:
     cdef int _faceMaxCount
 
 
-    def __init__(self, LutProvider luts, int nx, int ny, int nz):
+    def __init__(self, LutProvider luts, int nx, int ny, int nz,
+                 spacing=(1.0, 1.0, 1.0), origin=(0, 0, 0)):
         self.luts = luts
         self.nx, self.ny, self.nz = nx, ny, nz
+        self.sz, self.sy, self.sx = spacing
+        self.oz, self.oy, self.ox = origin
 
         # Allocate face layers
-        self.faceLayer1 = <int *>malloc(self.nx*self.ny*4 * sizeof(int))
-        self.faceLayer2 = <int *>malloc(self.nx*self.ny*4 * sizeof(int))
+        self.faceLayer1 = <int *>malloc(self.nx*self.ny*3 * sizeof(int))
+        self.faceLayer2 = <int *>malloc(self.nx*self.ny*3 * sizeof(int))
 
         if (self.faceLayer1 is NULL or self.faceLayer2 is NULL or
-            self.vv is NULL or self.vg is NULL or self._vertices is NULL or
+            self.vv is NULL or self.vg is NULL or self.vs is NULL or
+            self._vertices is NULL or
             self._normals is NULL or self._values is NULL or
             self._faces is NULL):
             raise MemoryError()
 
         cdef int i
-        for i in range(self.nx*self.ny*4):
+        for i in range(self.nx*self.ny*3):
             self.faceLayer1[i] = -1
             self.faceLayer2[i] = -1
         self.faceLayer = self.faceLayer1
@@ -206,6 +275,7 @@ cdef class Cell:
         # Init tiny arrays for vertices and gradients at the vertices
         self.vv = <cnp.float64_t *>malloc(8 * sizeof(cnp.float64_t))
         self.vg = <cnp.float64_t *>malloc(8*3 * sizeof(cnp.float64_t))
+        self.vs = <cnp.float64_t *>malloc(8 * sizeof(cnp.float64_t))
 
         # Init face layers
         self.faceLayer1 = NULL
@@ -218,12 +288,9 @@ cdef class Cell:
         self._normals = <cnp.float32_t *>malloc(self._vertexMaxCount*3 * sizeof(cnp.float32_t))
         self._values = <cnp.float32_t *>malloc(self._vertexMaxCount * sizeof(cnp.float32_t))
         # Clear normals and values
-        cdef int i, j
         if self._values is not NULL and self._normals is not NULL:
-            for i in range(self._vertexMaxCount):
-                self._values[i] = 0.0
-                for j in range(3):
-                    self._normals[i*3+j] = 0.0
+            memset(self._values, 0, self._vertexMaxCount * sizeof(cnp.float32_t))
+            memset(self._normals, 0, self._vertexMaxCount*3 * sizeof(cnp.float32_t))
 
         # Init faces
         self._faceCount = 0
@@ -234,6 +301,7 @@ cdef class Cell:
     def __dealloc__(self):
         free(self.vv)
         free(self.vg)
+        free(self.vs)
         free(self.faceLayer1)
         free(self.faceLayer2)
         free(self._vertices)
@@ -242,52 +310,42 @@ cdef class Cell:
         free(self._faces)
 
 
-    cdef void _increase_size_vertices(self) noexcept:
+    cdef void _increase_size_vertices(self) noexcept nogil:
         """ Increase the size of the vertices array by a factor two.
         """
-        # Allocate new array
+        # Grow the arrays in place where possible
         cdef int newMaxCount = self._vertexMaxCount * 2
-        cdef cnp.float32_t *newVertices = <cnp.float32_t *>malloc(newMaxCount*3 * sizeof(cnp.float32_t))
-        cdef cnp.float32_t *newNormals = <cnp.float32_t *>malloc(newMaxCount*3 * sizeof(cnp.float32_t))
-        cdef cnp.float32_t *newValues = <cnp.float32_t *>malloc(newMaxCount * sizeof(cnp.float32_t))
-        if newVertices is NULL or newNormals is NULL or newValues is NULL:
-            free(newVertices)
-            free(newNormals)
-            free(newValues)
-            raise MemoryError()
-        # Clear
-        cdef int i, j
-        for i in range(self._vertexCount, newMaxCount):
-            newValues[i] = 0.0
-            for j in range(3):
-                newNormals[i*3+j] = 0.0
-        # Copy
-        for i in range(self._vertexCount):
-            newValues[i] = self._values[i]
-            for j in range(3):
-                newVertices[i*3+j] = self._vertices[i*3+j]
-                newNormals[i*3+j] = self._normals[i*3+j]
-        # Apply
-        free(self._vertices); self._vertices = newVertices
-        free(self._normals); self._normals = newNormals
-        free(self._values); self._values = newValues
+        cdef cnp.float32_t *newVertices = <cnp.float32_t *>realloc(self._vertices, newMaxCount*3 * sizeof(cnp.float32_t))
+        if newVertices is NULL:
+            with gil:
+                raise MemoryError()
+        self._vertices = newVertices
+        cdef cnp.float32_t *newNormals = <cnp.float32_t *>realloc(self._normals, newMaxCount*3 * sizeof(cnp.float32_t))
+        if newNormals is NULL:
+            with gil:
+                raise MemoryError()
+        self._normals = newNormals
+        cdef cnp.float32_t *newValues = <cnp.float32_t *>realloc(self._values, newMaxCount * sizeof(cnp.float32_t))
+        if newValues is NULL:
+            with gil:
+                raise MemoryError()
+        self._values = newValues
+        # Clear the new part
+        cdef int n = newMaxCount - self._vertexMaxCount
+        memset(&self._values[self._vertexMaxCount], 0, n * sizeof(cnp.float32_t))
+        memset(&self._normals[self._vertexMaxCount*3], 0, n*3 * sizeof(cnp.float32_t))
         self._vertexMaxCount = newMaxCount
 
 
-    cdef void _increase_size_faces(self) noexcept:
+    cdef void _increase_size_faces(self) noexcept nogil:
         """ Increase the size of the faces array by a factor two.
         """
-        # Allocate new array
+        # Grow the array in place where possible
         cdef int newMaxCount = self._faceMaxCount * 2
-        cdef int *newFaces = <int *>malloc(newMaxCount * sizeof(int))
+        cdef int *newFaces = <int *>realloc(self._faces, newMaxCount * sizeof(int))
         if newFaces is NULL:
-            raise MemoryError()
-        # Copy
-        cdef int i
-        for i in range(self._faceCount):
-            newFaces[i] = self._faces[i]
-        # Apply
-        free(self._faces)
+            with gil:
+                raise MemoryError()
         self._faces = newFaces
         self._faceMaxCount = newMaxCount
 
@@ -295,31 +353,31 @@ cdef class Cell:
     ## Adding results
 
     cdef int add_vertex(self, cnp.float32_t x, cnp.float32_t y,
-                        cnp.float32_t z):
+                        cnp.float32_t z) noexcept nogil:
         """ Add a vertex to the result. Return index in vertex array.
         """
         # Check if array is large enough
         if self._vertexCount >= self._vertexMaxCount:
             self._increase_size_vertices()
-        # Add vertex
-        self._vertices[self._vertexCount*3+0] = x
-        self._vertices[self._vertexCount*3+1] = y
-        self._vertices[self._vertexCount*3+2] = z
+        # Add vertex (in z-y-x order, and scaled with the spacing)
+        self._vertices[self._vertexCount*3+0] = z * self.sz
+        self._vertices[self._vertexCount*3+1] = y * self.sy
+        self._vertices[self._vertexCount*3+2] = x * self.sx
         self._vertexCount += 1
         return self._vertexCount -1
 
 
     cdef void add_gradient(self, int vertexIndex, cnp.float32_t gx,
-                           cnp.float32_t gy, cnp.float32_t gz) noexcept:
+                           cnp.float32_t gy, cnp.float32_t gz) noexcept nogil:
         """ Add a gradient value to the vertex corresponding to the given index.
         """
-        self._normals[vertexIndex*3+0] += gx
+        self._normals[vertexIndex*3+0] += gz
         self._normals[vertexIndex*3+1] += gy
-        self._normals[vertexIndex*3+2] += gz
+        self._normals[vertexIndex*3+2] += gx
 
 
     cdef void add_gradient_from_index(self, int vertexIndex, int i,
-                                      cnp.float32_t strength) noexcept:
+                                      cnp.float32_t strength) noexcept nogil:
         """ Add a gradient value to the vertex corresponding to the given index.
         vertexIndex is the index in the large array of vertices that is returned.
         i is the index of the array of vertices 0-7 for the current cell.
@@ -328,7 +386,7 @@ cdef class Cell:
                           self.vg[i*3+1] * strength, self.vg[i*3+2] * strength)
 
 
-    cdef add_face(self, int index):
+    cdef void add_face(self, int index) noexcept nogil:
         """ Add a face to the result. Also updates the value.
         """
         # Check if array is large enough
@@ -343,25 +401,22 @@ cdef class Cell:
 
 
     ## Getting results
+    # Each of these hands the corresponding buffer over to the returned
+    # array, and can therefore only be called once.
 
     def get_vertices(self):
         """ Get the final vertex array.
         """
-        vertices = np.empty((self._vertexCount,3), np.float32)
-        cdef cnp.float32_t [:, :] vertices_ = vertices
-        cdef int i, j
-        for i in range(self._vertexCount):
-            for j in range(3):
-                vertices_[i, j] = self._vertices[i*3+j]
-        return vertices
+        cdef cnp.npy_intp shape[2]
+        shape[0], shape[1] = self._vertexCount, 3
+        return take_buffer(<void **>&self._vertices,
+                           self._vertexCount*3 * sizeof(cnp.float32_t),
+                           2, shape, cnp.NPY_FLOAT32)
 
     def get_normals(self):
         """ Get the final normals array.
         The normals are normalized to unit length.
         """
-        normals = np.empty((self._vertexCount,3), np.float32)
-        cdef cnp.float32_t [:, :] normals_ = normals
-
         cdef int i, j
         cdef cnp.float64_t length, dtmp
         for i in range(self._vertexCount):
@@ -372,29 +427,76 @@ cdef class Cell:
             if length > 0.0:
                 length = 1.0 / length**0.5
             for j in range(3):
-                normals_[i,j] = self._normals[i*3+j] * length
-        return normals
+                self._normals[i*3+j] = self._normals[i*3+j] * length
 
-    def get_faces(self):
-        faces = np.empty((self._faceCount,), np.int32)
-        cdef int [:] faces_ = faces
-        cdef int i
-        for i in range(self._faceCount):
-            faces_[i] = self._faces[i]
-        return faces
+        cdef cnp.npy_intp shape[2]
+        shape[0], shape[1] = self._vertexCount, 3
+        return take_buffer(<void **>&self._normals,
+                           self._vertexCount*3 * sizeof(cnp.float32_t),
+                           2, shape, cnp.NPY_FLOAT32)
+
+    def get_faces(self, bint flip=False):
+        """ Get the final faces array, of shape (F, 3).
+        If flip is set, the order of the vertices of each face is reversed.
+        """
+        cdef int i, tmp
+        if flip:
+            for i in range(0, self._faceCount, 3):
+                tmp = self._faces[i]
+                self._faces[i] = self._faces[i+2]
+                self._faces[i+2] = tmp
+
+        cdef cnp.npy_intp shape[2]
+        shape[0], shape[1] = self._faceCount // 3, 3
+        return take_buffer(<void **>&self._faces,
+                           self._faceCount * sizeof(int),
+                           2, shape, cnp.NPY_INT32)
 
     def get_values(self):
-        values = np.empty((self._vertexCount,), np.float32)
-        cdef cnp.float32_t [:] values_ = values
-        cdef int i
-        for i in range(self._vertexCount):
-            values_[i] = self._values[i]
-        return values
+        cdef cnp.npy_intp shape[1]
+        shape[0] = self._vertexCount
+        return take_buffer(<void **>&self._values,
+                           self._vertexCount * sizeof(cnp.float32_t),
+                           1, shape, cnp.NPY_FLOAT32)
+
+
+    ## Merging results of cells that processed different slabs
+
+    cdef void merge(self, Cell other, int *remap) noexcept nogil:
+        """ Append the results of another cell to the results of this cell.
+
+        remap maps the vertex indices of the other cell to the vertex
+        indices of this cell, and is -1 for vertices that this cell does
+        not have yet. These vertices are appended, in order, after which
+        remap is updated. The normals of shared vertices are summed, and
+        their values combined, as if all faces had been added to one cell.
+        """
+        cdef int i, j, index
+        for i in range(other._vertexCount):
+            index = remap[i]
+            if index < 0:
+                if self._vertexCount >= self._vertexMaxCount:
+                    self._increase_size_vertices()
+                index = self._vertexCount
+                for j in range(3):
+                    self._vertices[index*3+j] = other._vertices[i*3+j]
+                self._vertexCount += 1
+                remap[i] = index
+            for j in range(3):
+                self._normals[index*3+j] += other._normals[i*3+j]
+            if other._values[i] > self._values[index]:
+                self._values[index] = other._values[i]
+
+        for i in range(other._faceCount):
+            if self._faceCount >= self._faceMaxCount:
+                self._increase_size_faces()
+            self._faces[self._faceCount] = remap[other._faces[i]]
+            self._faceCount += 1
 
 
     ## Called from marching cube function
 
-    cdef void new_z_value(self) noexcept:
+    cdef void new_z_value(self) noexcept nogil:
         """ This method should be called each time a new z layer is entered.
         We will swap the layers with face information and empty the second.
         """
@@ -402,13 +504,13 @@ cdef class Cell:
         self.faceLayer1, self.faceLayer2 = self.faceLayer2, self.faceLayer1
         # Empty last
         cdef int i
-        for i in range(self.nx*self.ny*4):
+        for i in range(self.nx*self.ny*3):
             self.faceLayer2[i] = -1
 
 
     cdef void set_cube(self,    cnp.float64_t isovalue, int x, int y, int z, int step,
                                 cnp.float64_t v0, cnp.float64_t v1, cnp.float64_t v2, cnp.float64_t v3,
-                                cnp.float64_t v4, cnp.float64_t v5, cnp.float64_t v6, cnp.float64_t v7) noexcept:
+                                cnp.float64_t v4, cnp.float64_t v5, cnp.float64_t v6, cnp.float64_t v7) noexcept nogil:
         """ Set the cube to the new location.
 
         Set the values of the cube corners. The isovalue is subtracted
@@ -435,23 +537,19 @@ cdef class Cell:
         self.v6 = v6 - isovalue
         self.v7 = v7 - isovalue
 
-        # Calculate index
-        cdef int index = 0
-        if self.v0 > 0.0:   index += 1
-        if self.v1 > 0.0:   index += 2
-        if self.v2 > 0.0:   index += 4
-        if self.v3 > 0.0:   index += 8
-        if self.v4 > 0.0:   index += 16
-        if self.v5 > 0.0:   index += 32
-        if self.v6 > 0.0:   index += 64
-        if self.v7 > 0.0:   index += 128
-        self.index = index
+        # Calculate index. The comparisons are combined as bits, rather
+        # than tested one by one, to avoid hard to predict branches.
+        self.index = ( (<int>(self.v0 > 0.0))      | (<int>(self.v1 > 0.0) << 1) |
+                       (<int>(self.v2 > 0.0) << 2) | (<int>(self.v3 > 0.0) << 3) |
+                       (<int>(self.v4 > 0.0) << 4) | (<int>(self.v5 > 0.0) << 5) |
+                       (<int>(self.v6 > 0.0) << 6) | (<int>(self.v7 > 0.0) << 7) )
 
         # Reset c12
         self.v12_calculated = 0
+        self.v12_index = -1
 
 
-    cdef void add_triangles(self, Lut lut, int lutIndex, int nt) noexcept:
+    cdef void add_triangles(self, Lut lut, int lutIndex, int nt) noexcept nogil:
         """ Add triangles.
 
         The vertices for the triangles are specified in the given
@@ -474,7 +572,7 @@ cdef class Cell:
                 self._add_face_from_edge_index(vi)
 
 
-    cdef void add_triangles2(self, Lut lut, int lutIndex, int lutIndex2, int nt) noexcept:
+    cdef void add_triangles2(self, Lut lut, int lutIndex, int lutIndex2, int nt) noexcept nogil:
         """ Same as add_triangles, except that now the geometry is in a LUT
         with 3 dimensions, and an extra index is provided.
 
@@ -492,7 +590,7 @@ cdef class Cell:
 
     ## Used internally
 
-    cdef void _add_face_from_edge_index(self, int vi) noexcept:
+    cdef void _add_face_from_edge_index(self, int vi) noexcept nogil:
         """ Add one face from an edge index. Only adds a face if the
         vertex already exists. Otherwise also adds a vertex and applies
         interpolation.
@@ -507,33 +605,29 @@ cdef class Cell:
         cdef cnp.float64_t fx, fy, fz, ff
         cdef cnp.float64_t stp = <cnp.float64_t>self.step
 
-        # Get index in the face layer and corresponding vertex number
-        indexInFaceLayer = self.get_index_in_facelayer(vi)
-        indexInVertexArray = self.faceLayer[indexInFaceLayer]
-
         # If we have the center vertex, we have things pre-calculated,
         # otherwise we need to interpolate.
         # In both cases we distinguish between having this vertex already
         # or not.
 
         if vi == 12: # center vertex
+            # The center vertex is never shared with another cell, so it
+            # is kept on the cell instead of in the face layers
             if self.v12_calculated == 0:
                 self.calculate_center_vertex()
-            if indexInVertexArray >= 0:
-                # Vertex already calculated, only need to add face and gradient
-                self.add_face(indexInVertexArray)
-                self.add_gradient(indexInVertexArray, self.v12_xg, self.v12_yg, self.v12_zg)
-            else:
+            if self.v12_index < 0:
                 # Add precalculated center vertex position (is interpolated)
-                indexInVertexArray = self.add_vertex( self.v12_x, self.v12_y, self.v12_z)
-                # Update face layer
-                self.faceLayer[indexInFaceLayer] = indexInVertexArray
-                # Add face and gradient
-                self.add_face(indexInVertexArray)
-                self.add_gradient(indexInVertexArray, self.v12_xg, self.v12_yg, self.v12_zg)
+                self.v12_index = self.add_vertex( self.v12_x, self.v12_y, self.v12_z)
+            # Add face and gradient
+            self.add_face(self.v12_index)
+            self.add_gradient(self.v12_index, self.v12_xg, self.v12_yg, self.v12_zg)
 
         else:
 
+            # Get index in the face layer and corresponding vertex number
+            indexInFaceLayer = self.get_index_in_facelayer(vi)
+            indexInVertexArray = self.faceLayer[indexInFaceLayer]
+
             # Get relative edge indices for x, y and z
             dx1, dx2 = self.luts.EDGESRELX.get2(vi,0), self.luts.EDGESRELX.get2(vi,1)
             dy1, dy2 = self.luts.EDGESRELY.get2(vi,0), self.luts.EDGESRELY.get2(vi,1)
@@ -541,9 +635,9 @@ cdef class Cell:
             # Make two vertex indices
             index1 = dz1*4 + dy1*2 + dx1
             index2 = dz2*4 + dy2*2 + dx2
-            # Define strength of both corners
-            tmpf1 = 1.0 / (FLT_EPSILON + dabs(self.vv[index1]))
-            tmpf2 = 1.0 / (FLT_EPSILON + dabs(self.vv[index2]))
+            # Get strength of both corners
+            tmpf1 = self.vs[index1]
+            tmpf2 = self.vs[index2]
 
             # print('indexInVertexArray', self.x, self.y, self.z, '-', vi, indexInVertexArray, indexInFaceLayer)
 
@@ -561,9 +655,9 @@ cdef class Cell:
 
                 # Add vertex
                 indexInVertexArray = self.add_vertex(
-                                <cnp.float64_t>self.x + stp*fx/ff,
-                                <cnp.float64_t>self.y + stp*fy/ff,
-                                <cnp.float64_t>self.z + stp*fz/ff )
+                                <cnp.float64_t>(self.x + self.ox) + stp*fx/ff,
+                                <cnp.float64_t>(self.y + self.oy) + stp*fy/ff,
+                                <cnp.float64_t>(self.z + self.oz) + stp*fz/ff )
                 # Update face layer
                 self.faceLayer[indexInFaceLayer] = indexInVertexArray
                 # Add face and gradient
@@ -579,7 +673,7 @@ cdef class Cell:
 
 
 
-    cdef int get_index_in_facelayer(self, int vi):
+    cdef int get_index_in_facelayer(self, int vi) noexcept nogil:
         """
         Get the index of a vertex position, given the edge on which it lies.
         We keep a list of faces so we can reuse vertices. This improves
@@ -587,8 +681,9 @@ cdef class Cell:
         compact and can be visualized better because normals can be
         interpolated.
 
-        For each cell, we store 4 vertex indices; all other edges can be
-        represented as the edge of another cell.  The fourth is the center vertex.
+        For each cell, we store 3 vertex indices; all other edges can be
+        represented as the edge of another cell. The center vertex (12) is
+        not shared between cells and is not handled here.
 
         This method returns -1 if no vertex has been defined yet.
 
@@ -632,7 +727,7 @@ cdef class Cell:
             elif vi == 3:  # no step
                 j = 1
 
-        elif vi < 12:
+        else:
             # 4 vertical edges
             faceLayer = self.faceLayer1
             j = 2
@@ -645,17 +740,12 @@ cdef class Cell:
             elif vi == 11:  # step in y
                 i += self.nx * self.step
 
-        else:
-            # center vertex
-            faceLayer = self.faceLayer1
-            j = 3
-
         # Store facelayer and return index
         self.faceLayer = faceLayer # Dirty way of returning a value
-        return 4*i + j
+        return 3*i + j
 
 
-    cdef void prepare_for_adding_triangles(self) noexcept:
+    cdef void prepare_for_adding_triangles(self) noexcept nogil:
         """ Calculates some things to help adding the triangles:
         array with corner values, max corner value, gradient at each corner.
         """
@@ -683,6 +773,13 @@ cdef class Cell:
                 vmin = self.vv[i]
         self.vmax = vmax-vmin
 
+        # Calculate the "strength" of each corner, which is used to
+        # interpolate the vertices on the edges and the center vertex.
+        # This is done once for all corners, rather than for both corners
+        # of each edge that is visited.
+        for i in range(8):
+            self.vs[i] = 1.0 / (FLT_EPSILON + dabs(self.vv[i]))
+
         # Calculate gradients
         # Derivatives, selected to always point in same direction.
         # Note that many corners have the same components as other points,
@@ -698,22 +795,17 @@ cdef class Cell:
         self.vg[7*3+0], self.vg[7*3+1], self.vg[7*3+2] = self.v7-self.v6, self.v4-self.v7, self.v3-self.v7
 
 
-    cdef void calculate_center_vertex(self) noexcept:
+    cdef void calculate_center_vertex(self) noexcept nogil:
         """ Calculate interpolated center vertex and its gradient.
         """
         cdef cnp.float64_t v0, v1, v2, v3, v4, v5, v6, v7
         cdef cnp.float64_t fx, fy, fz, ff
         fx, fy, fz, ff = 0.0, 0.0, 0.0, 0.0
 
-        # Define "strength" of each corner of the cube that we need
-        v0 = 1.0 / (FLT_EPSILON + dabs(self.v0))
-        v1 = 1.0 / (FLT_EPSILON + dabs(self.v1))
-        v2 = 1.0 / (FLT_EPSILON + dabs(self.v2))
-        v3 = 1.0 / (FLT_EPSILON + dabs(self.v3))
-        v4 = 1.0 / (FLT_EPSILON + dabs(self.v4))
-        v5 = 1.0 / (FLT_EPSILON + dabs(self.v5))
-        v6 = 1.0 / (FLT_EPSILON + dabs(self.v6))
-        v7 = 1.0 / (FLT_EPSILON + dabs(self.v7))
+        # Get "strength" of each corner of the cube, note the misalignment
+        # of the vv array (see prepare_for_adding_triangles)
+        v0, v1, v2, v3 = self.vs[0], self.vs[1], self.vs[3], self.vs[2]
+        v4, v5, v6, v7 = self.vs[4], self.vs[5], self.vs[7], self.vs[6]
 
         # Apply a kind of center-of-mass method
         fx += 0.0*v0;  fy += 0.0*v0;  fz += 0.0*v0;  ff += v0
@@ -727,9 +819,9 @@ cdef class Cell:
 
         # Store
         cdef cnp.float64_t stp = <cnp.float64_t>self.step
-        self.v12_x = self.x + stp * fx / ff
-        self.v12_y = self.y + stp * fy / ff
-        self.v12_z = self.z + stp * fz / ff
+        self.v12_x = (self.x + self.ox) + stp * fx / ff
+        self.v12_y = (self.y + self.oy) + stp * fy / ff
+        self.v12_z = (self.z + self.oz) + stp * fz / ff
 
         # Also pre-calculate gradient of center
         # note that prepare_for_adding_triangles() must have been called for
@@ -746,10 +838,41 @@ cdef class Cell:
 
 
 
+cdef class TableBlock:
+    """ A block of memory into which tables (numpy arrays) are copied one
+    after another. Each table starts at a cache line (of 64 bytes), so that
+    the lookups of a cell touch as few cache lines as possible. A new block
+    is started if a table does not fit in the current one.
+    """
+
+    cdef object block
+    cdef Py_ssize_t start
+
+    def __init__(self, Py_ssize_t size=32768):
+        self.new_block(size)
+
+    cdef void new_block(self, Py_ssize_t size):
+        self.block = np.empty(size + 64, dtype=np.int8)
+        self.start = -self.block.ctypes.data % 64
+
+    cdef object add(self, table):
+        """ Copy the table into the block and return the copy.
+        """
+        table = np.asarray(table)
+        cdef Py_ssize_t size = (table.size + 63) // 64 * 64
+        if self.start + size > self.block.size:
+            self.new_block(max(size, self.block.size - 64))
+        view = self.block[self.start:self.start + table.size].reshape(table.shape)
+        view[...] = table
+        self.start += size
+        return view
+
+
 cdef class Lut:
     """ Representation of a lookup table.
     The tables are initially defined as numpy arrays. On initialization,
-    this class converts them to a C array for fast access.
+    this class obtains a pointer to the data of the array (converted to a
+    contiguous int8 array if needed) for fast access.
     This class defines functions to look up values using 1, 2 or 3 indices.
     """
 
@@ -757,8 +880,9 @@ cdef class Lut:
     cdef int L0 # Length
     cdef int L1 # size of tuple
     cdef int L2 # size of tuple in tuple (if any)
+    cdef object array # The array that owns VALUES
 
-    def __init__(self, array):
+    def __init__(self, array, TableBlock block=None):
 
         # Get the shape of the LUT
         self.L1 = 1
@@ -770,30 +894,21 @@ cdef class Lut:
         if array.ndim > 2:
             self.L2 = array.shape[2]
 
-        # Copy the contents
-        array = array.ravel()
-        cdef int n, N
-        N = self.L0 * self.L1 * self.L2
-        self.VALUES = <signed char *> malloc(N * sizeof(signed char))
-        if self.VALUES is NULL:
-            raise MemoryError()
-        for n in range(N):
-            self.VALUES[n] = array[n]
-
-    def __cinit__(self):
-        self.VALUES = NULL
-
-    def __dealloc__(self):
-        if self.VALUES is not NULL:
-            free(self.VALUES)
+        # Copy the contents into the block if given, otherwise refer to
+        # them, copying them only if necessary
+        if block is not None:
+            self.array = block.add(array)
+        else:
+            self.array = np.ascontiguousarray(array, dtype=np.int8)
+        self.VALUES = <signed char *> cnp.PyArray_DATA(self.array)
 
-    cdef int get1(self, int i0):
+    cdef int get1(self, int i0) noexcept nogil:
         return self.VALUES[i0]
 
-    cdef int get2(self, int i0, int i1):
+    cdef int get2(self, int i0, int i1) noexcept nogil:
         return self.VALUES[i0*self.L1 + i1]
 
-    cdef int get3(self, int i0, int i1, int i2):
+    cdef int get3(self, int i0, int i1, int i2) noexcept nogil:
         return self.VALUES[i0*self.L1*self.L2 + i1*self.L2 + i2]
 
 
@@ -876,99 +991,194 @@ cdef class LutProvider:
             SUBCONFIG13,
             ):
 
-        self.EDGESRELX = Lut(EDGESRELX)
-        self.EDGESRELY = Lut(EDGESRELY)
-        self.EDGESRELZ = Lut(EDGESRELZ)
-
-        self.CASESCLASSIC = Lut(CASESCLASSIC)
-        self.CASES = Lut(CASES)
-
-        self.TILING1 = Lut(TILING1)
-        self.TILING2 = Lut(TILING2)
-        self.TILING3_1 = Lut(TILING3_1)
-        self.TILING3_2 = Lut(TILING3_2)
-        self.TILING4_1 = Lut(TILING4_1)
-        self.TILING4_2 = Lut(TILING4_2)
-        self.TILING5 = Lut(TILING5)
-        self.TILING6_1_1 = Lut(TILING6_1_1)
-        self.TILING6_1_2 = Lut(TILING6_1_2)
-        self.TILING6_2 = Lut(TILING6_2)
-        self.TILING7_1 = Lut(TILING7_1)
-        self.TILING7_2 = Lut(TILING7_2)
-        self.TILING7_3 = Lut(TILING7_3)
-        self.TILING7_4_1 = Lut(TILING7_4_1)
-        self.TILING7_4_2 = Lut(TILING7_4_2)
-        self.TILING8 = Lut(TILING8)
-        self.TILING9 = Lut(TILING9)
-        self.TILING10_1_1 = Lut(TILING10_1_1)
-        self.TILING10_1_1_ = Lut(TILING10_1_1_)
-        self.TILING10_1_2 = Lut(TILING10_1_2)
-        self.TILING10_2 = Lut(TILING10_2)
-        self.TILING10_2_ = Lut(TILING10_2_)
-        self.TILING11 = Lut(TILING11)
-        self.TILING12_1_1 = Lut(TILING12_1_1)
-        self.TILING12_1_1_ = Lut(TILING12_1_1_)
-        self.TILING12_1_2 = Lut(TILING12_1_2)
-        self.TILING12_2 = Lut(TILING12_2)
-        self.TILING12_2_ = Lut(TILING12_2_)
-        self.TILING13_1 = Lut(TILING13_1)
-        self.TILING13_1_ = Lut(TILING13_1_)
-        self.TILING13_2 = Lut(TILING13_2)
-        self.TILING13_2_ = Lut(TILING13_2_)
-        self.TILING13_3 = Lut(TILING13_3)
-        self.TILING13_3_ = Lut(TILING13_3_)
-        self.TILING13_4 = Lut(TILING13_4)
-        self.TILING13_5_1 = Lut(TILING13_5_1)
-        self.TILING13_5_2 = Lut(TILING13_5_2)
-        self.TILING14 = Lut(TILING14)
-
-        self.TEST3 = Lut(TEST3)
-        self.TEST4 = Lut(TEST4)
-        self.TEST6 = Lut(TEST6)
-        self.TEST7 = Lut(TEST7)
-        self.TEST10 = Lut(TEST10)
-        self.TEST12 = Lut(TEST12)
-        self.TEST13 = Lut(TEST13)
-
-        self.SUBCONFIG13 = Lut(SUBCONFIG13)
-
-def marching_cubes(cnp.float32_t[:, :, :] im not None, cnp.float64_t isovalue,
-                   LutProvider luts, int st=1, int classic=0,
+        # Pack all tables in one block of memory (of about 20 kB, which
+        # fits in the L1 cache), instead of scattering them over the heap
+        cdef TableBlock block = TableBlock()
+
+        self.EDGESRELX = Lut(EDGESRELX, block)
+        self.EDGESRELY = Lut(EDGESRELY, block)
+        self.EDGESRELZ = Lut(EDGESRELZ, block)
+
+        self.CASESCLASSIC = Lut(CASESCLASSIC, block)
+        self.CASES = Lut(CASES, block)
+
+        self.TILING1 = Lut(TILING1, block)
+        self.TILING2 = Lut(TILING2, block)
+        self.TILING3_1 = Lut(TILING3_1, block)
+        self.TILING3_2 = Lut(TILING3_2, block)
+        self.TILING4_1 = Lut(TILING4_1, block)
+        self.TILING4_2 = Lut(TILING4_2, block)
+        self.TILING5 = Lut(TILING5, block)
+        self.TILING6_1_1 = Lut(TILING6_1_1, block)
+        self.TILING6_1_2 = Lut(TILING6_1_2, block)
+        self.TILING6_2 = Lut(TILING6_2, block)
+        self.TILING7_1 = Lut(TILING7_1, block)
+        self.TILING7_2 = Lut(TILING7_2, block)
+        self.TILING7_3 = Lut(TILING7_3, block)
+        self.TILING7_4_1 = Lut(TILING7_4_1, block)
+        self.TILING7_4_2 = Lut(TILING7_4_2, block)
+        self.TILING8 = Lut(TILING8, block)
+        self.TILING9 = Lut(TILING9, block)
+        self.TILING10_1_1 = Lut(TILING10_1_1, block)
+        self.TILING10_1_1_ = Lut(TILING10_1_1_, block)
+        self.TILING10_1_2 = Lut(TILING10_1_2, block)
+        self.TILING10_2 = Lut(TILING10_2, block)
+        self.TILING10_2_ = Lut(TILING10_2_, block)
+        self.TILING11 = Lut(TILING11, block)
+        self.TILING12_1_1 = Lut(TILING12_1_1, block)
+        self.TILING12_1_1_ = Lut(TILING12_1_1_, block)
+        self.TILING12_1_2 = Lut(TILING12_1_2, block)
+        self.TILING12_2 = Lut(TILING12_2, block)
+        self.TILING12_2_ = Lut(TILING12_2_, block)
+        self.TILING13_1 = Lut(TILING13_1, block)
+        self.TILING13_1_ = Lut(TILING13_1_, block)
+        self.TILING13_2 = Lut(TILING13_2, block)
+        self.TILING13_2_ = Lut(TILING13_2_, block)
+        self.TILING13_3 = Lut(TILING13_3, block)
+        self.TILING13_3_ = Lut(TILING13_3_, block)
+        self.TILING13_4 = Lut(TILING13_4, block)
+        self.TILING13_5_1 = Lut(TILING13_5_1, block)
+        self.TILING13_5_2 = Lut(TILING13_5_2, block)
+        self.TILING14 = Lut(TILING14, block)
+
+        self.TEST3 = Lut(TEST3, block)
+        self.TEST4 = Lut(TEST4, block)
+        self.TEST6 = Lut(TEST6, block)
+        self.TEST7 = Lut(TEST7, block)
+        self.TEST10 = Lut(TEST10, block)
+        self.TEST12 = Lut(TEST12, block)
+        self.TEST13 = Lut(TEST13, block)
+
+        self.SUBCONFIG13 = Lut(SUBCONFIG13, block)
+
+def marching_cubes(const volume_t[:, :, :] im not None, cnp.float64_t isovalue,
+                   LutProvider luts, int st=1, bint classic=False,
                    cnp.ndarray[cnp.npy_bool, ndim=3, cast=True] mask=None, 
-                   int single_mesh=0):
-    """ marching_cubes(im, cnp.float64_t isovalue, LutProvider luts, int st=1, int classic=0)
+                   bint single_mesh=False, bint descent=False, spacing=(1.0, 1.0, 1.0),
+                   origin=(0, 0, 0), int num_threads=0):
+    """ marching_cubes(im, cnp.float64_t isovalue, LutProvider luts, int st=1, bint classic=False)
     Main entry to apply marching cubes.
 
+    Vertices and normals are returned in z-y-x order, the vertices offset
+    by the (z, y, x) origin of im (when it is part of a larger volume) and
+    scaled with the given (z, y, x) spacing. The triangles are
+    right-handed, unless descent is set, in which case they are
+    left-handed (corresponding to gradient descent toward objects).
+
     Masked version of marching cubes. This function will check a
     masking array (same size as im) to decide if the algorithm must be
     computed for a given voxel. This adds a small overhead that
     rapidly gets compensated by the fewer computed cubes
     Returns (vertices, faces, normals, values)
+
+    The layers of cells are divided in num_threads slabs along z (or as
+    many as the OpenMP default number of threads if num_threads is 0),
+    which are processed in parallel, each by its own Cell. Only the
+    vertices on the plane between two slabs are shared by them, and these
+    are merged afterwards, such that the result is the same as when the
+    volume is processed as a whole.
     """
     # Get dimemsnions
     cdef int Nx, Ny, Nz
     Nx, Ny, Nz = im.shape[2], im.shape[1], im.shape[0]
 
-    # Create cell to use throughout
-    cdef Cell cell = Cell(luts, Nx, Ny, Nz)
+    # Typedef variables
+    cdef int k, i, j
+    cdef bint no_mask = mask is None
+    cdef const cnp.uint8_t[:, :, :] mask_view = None
+    if not no_mask:
+        mask_view = mask.view(np.uint8)
+    assert st > 0
+
+    # Divide the layers of cells in slabs, with one cell per slab
+    cdef int n_layers = max((Nz - 1) // st, 0)
+    cdef int n_slabs = num_threads if num_threads > 0 else MC_MAX_THREADS()
+    n_slabs = max(1, min(n_slabs, n_layers))
+
+    cells = [Cell(luts, Nx, Ny, Nz, spacing, origin) for k in range(n_slabs)]
+    cdef PyObject **slab_cells = <PyObject **>malloc(n_slabs * sizeof(PyObject *))
+    cdef int *bottoms = NULL  # vertex indices on the bottom plane of each slab
+    cdef int *remap = NULL
+    cdef int *prev_remap = NULL
+    cdef Cell cell, prev
+    if n_slabs > 1:
+        bottoms = <int *>malloc(n_slabs*Nx*Ny*2 * sizeof(int))
+    if slab_cells is NULL or (n_slabs > 1 and bottoms is NULL):
+        free(slab_cells)
+        free(bottoms)
+        raise MemoryError()
+    for k in range(n_slabs):
+        slab_cells[k] = <PyObject *>cells[k]
+
+    with nogil:
+        for k in prange(n_slabs, num_threads=n_slabs, schedule='static'):
+            march_slab(<Cell>slab_cells[k], im, mask_view, no_mask, isovalue,
+                       luts, st, classic, single_mesh,
+                       k * n_layers // n_slabs, (k + 1) * n_layers // n_slabs,
+                       bottoms + k*Nx*Ny*2 if k > 0 else NULL)
+
+    # Merge the results of all slabs into the first cell. The vertices on the
+    # bottom plane of a slab are those on the top plane of the previous one.
+    cell = cells[0]
+    try:
+        for k in range(1, n_slabs):
+            prev, other = cells[k - 1], cells[k]
+            remap = <int *>malloc(max((<Cell>other)._vertexCount, 1) * sizeof(int))
+            if remap is NULL:
+                raise MemoryError()
+            for i in range((<Cell>other)._vertexCount):
+                remap[i] = -1
+            for i in range(Nx*Ny):
+                for j in range(2):
+                    if (bottoms[k*Nx*Ny*2 + 2*i + j] >= 0 and
+                            prev.faceLayer2[3*i + j] >= 0):
+                        remap[bottoms[k*Nx*Ny*2 + 2*i + j]] = (
+                            prev.faceLayer2[3*i + j] if prev_remap is NULL
+                            else prev_remap[prev.faceLayer2[3*i + j]])
+            cell.merge(other, remap)
+            free(prev_remap)
+            prev_remap, remap = remap, NULL
+    finally:
+        free(prev_remap)
+        free(remap)
+        free(bottoms)
+        free(slab_cells)
+
+    # Done
+    return cell.get_vertices(), cell.get_faces(descent), cell.get_normals(), cell.get_values()
+
+
+cdef void march_slab(Cell cell, const volume_t[:, :, :] im,
+                     const cnp.uint8_t[:, :, :] mask, bint no_mask,
+                     cnp.float64_t isovalue, LutProvider luts, int st,
+                     bint classic, bint single_mesh, int layer_begin,
+                     int layer_end, int *bottom) noexcept nogil:
+    """ Apply marching cubes to the layers of cells from layer_begin up to
+    (not including) layer_end, adding the results to the given cell.
+
+    If bottom is not NULL, the vertex indices on the horizontal edges of
+    the bottom plane of the slab (as stored in the face layer) are copied
+    to it, so that the slab can be merged with the one below it.
+    """
+    cdef int Nx, Ny
+    Nx, Ny = im.shape[2], im.shape[1]
 
     # Typedef variables
     cdef int x, y, z, x_st, y_st, z_st
+    cdef int i, layer
     cdef int nt
     cdef int case, config
-    cdef bint no_mask = mask is None
+    cdef bint all_valid
     # Unfortunately specifying a step in range() significantly degrades
     # performance. Therefore we use a while loop.
     # we have:  max_x = Nx_bound + st + st - 1
     #       ->  Nx_bound = max_allowable_x + 1 - 2 * st
     #       ->  Nx_bound = Nx - 2 * st
-    assert st > 0
-    cdef int Nx_bound, Ny_bound, Nz_bound
-    Nx_bound, Ny_bound, Nz_bound = Nx - 2 * st, Ny - 2 * st, Nz - 2 * st  # precalculated index range
+    cdef int Nx_bound, Ny_bound
+    Nx_bound, Ny_bound = Nx - 2 * st, Ny - 2 * st  # precalculated index range
 
-    z = -st
-    while z < Nz_bound:
-        z += st
+    for layer in range(layer_begin, layer_end):
+        z = layer * st
         z_st = z + st
 
         cell.new_z_value()  # Indicate that we enter a new layer
@@ -982,19 +1192,25 @@ def marching_cubes(cnp.float32_t[:, :, :] im not None, cnp.float64_t isovalue,
                 x += st
                 x_st = x + st
                 if no_mask or mask[z_st, y_st, x_st]:
-                    # Initialize cell
-                    all_valid = \
-                        (im[z ,y, x] > -1)  & (im[z ,y, x_st] > -1)  & (im[z,y_st, x_st] > -1)  & \
-                        (im[z ,y_st, x] > -1)  & (im[z_st ,y, x] > -1)  & (im[z_st ,y,x_st] > -1) \
-                        & (im[z_st ,y_st, x_st] > -1)  & (im[z_st ,y_st,x] > -1)
-
-                    if single_mesh and not all_valid:
+                    if single_mesh:
+                        all_valid = \
+                            (<cnp.float32_t>im[z ,y, x] > -1)  & (<cnp.float32_t>im[z ,y, x_st] > -1)  & (<cnp.float32_t>im[z,y_st, x_st] > -1)  & \
+                            (<cnp.float32_t>im[z ,y_st, x] > -1)  & (<cnp.float32_t>im[z_st ,y, x] > -1)  & (<cnp.float32_t>im[z_st ,y,x_st] > -1) \
+                            & (<cnp.float32_t>im[z_st ,y_st, x_st] > -1)  & (<cnp.float32_t>im[z_st ,y_st,x] > -1)
+                        if not all_valid:
+                            continue
+
+                    # Initialize cell, with the corners rounded to float32 as
+                    # for a volume that is cast to float32
+                    cell.set_cube(isovalue, x, y, z, st,
+                        <cnp.float32_t>im[z   ,y, x], <cnp.float32_t>im[z   ,y, x_st], <cnp.float32_t>im[z   ,y_st, x_st], <cnp.float32_t>im[z   ,y_st, x],
+                        <cnp.float32_t>im[z_st,y, x], <cnp.float32_t>im[z_st,y, x_st], <cnp.float32_t>im[z_st,y_st, x_st], <cnp.float32_t>im[z_st,y_st, x])
+
+                    # Fast path: if all corners are on the same side of the
+                    # isovalue, the surface does not pass through this cell
+                    if cell.index == 0 or cell.index == 255:
                         continue
-                    else:
-                        cell.set_cube(isovalue, x, y, z, st,
-                            im[z   ,y, x], im[z   ,y, x_st], im[z   ,y_st, x_st], im[z   ,y_st, x],
-                            im[z_st,y, x], im[z_st,y, x_st], im[z_st,y_st, x_st], im[z_st,y_st, x])
-                            
+
                     # Do classic!
                     if classic:
                         # Determine number of vertices
@@ -1011,12 +1227,15 @@ def marching_cubes(cnp.float32_t[:, :, :] im not None, cnp.float64_t isovalue,
                             config = luts.CASES.get2(cell.index, 1)
                             the_big_switch(luts, cell, case, config)
 
-    # Done
-    return cell.get_vertices(), cell.get_faces(), cell.get_normals(), cell.get_values()
+        # Keep the vertices of the bottom plane, before the layer is swapped
+        if layer == layer_begin and bottom is not NULL:
+            for i in range(Nx*Ny):
+                bottom[2*i] = cell.faceLayer1[3*i]
+                bottom[2*i+1] = cell.faceLayer1[3*i+1]
 
 
 
-cdef void the_big_switch(LutProvider luts, Cell cell, int case, int config) noexcept:
+cdef void the_big_switch(LutProvider luts, Cell cell, int case, int config) noexcept nogil:
     """ The big switch (i.e. if-statement) that I meticulously ported from
     the source code provided by Lewiner et. al.
 
@@ -1279,13 +1498,14 @@ cdef void the_big_switch(LutProvider luts, Cell cell, int case, int config) noex
             cell.add_triangles(luts.TILING13_1_, config, 4)
         #
         else:
-            print("Marching Cubes: Impossible case 13?" )
+            with gil:
+                print("Marching Cubes: Impossible case 13?" )
 
     elif case == 14 :
         cell.add_triangles(luts.TILING14, config, 4)
 
 
-cdef int test_face(Cell cell, int face):
+cdef int test_face(Cell cell, int face) noexcept nogil:
     """ Return True of the face contains part of the surface.
     """
 
@@ -1317,7 +1537,7 @@ cdef int test_face(Cell cell, int face):
         return face * A * AC_BD >= 0;  # face and A invert signs
 
 
-cdef int test_internal(Cell cell, LutProvider luts, int case, int config, int subconfig, int s):
+cdef int test_internal(Cell cell, LutProvider luts, int case, int config, int subconfig, int s) noexcept nogil:
     """ Return True of the face contains part of the surface.
     """
 
@@ -1422,9 +1642,11 @@ cdef int test_internal(Cell cell, LutProvider luts, int case, int config, int su
             Ct = cell.v1 + ( cell.v5 - cell.v1 ) * t
             Dt = cell.v0 + ( cell.v4 - cell.v0 ) * t
         else:
-            print( "Invalid edge %i." % edge )
+            with gil:
+                print( "Invalid edge %i." % edge )
     else:
-        print( "Invalid ambiguous case %i." % case )
+        with gil:
+            print( "Invalid ambiguous case %i." % case )
 
     # Process results
     if At >= 0: test += 1
@@ -1,9 +1,16 @@
+import base64
+
 import numpy as np
 import pytest
 from numpy.testing import assert_allclose
 
 from skimage.draw import ellipsoid, ellipsoid_stats
 from skimage.measure import marching_cubes, mesh_surface_area
+from skimage.measure import _marching_cubes_lewiner_luts as mcluts
+from skimage.measure._marching_cubes_lewiner import (
+    _load_mc_luts,
+    _marching_cubes_unchecked,
+)
 
 
 def test_marching_cubes_isotropic():
@@ -79,6 +86,16 @@ def test_invalid_input():
     with pytest.raises(ValueError):
         marching_cubes(ellipsoid_isotropic, 0.0, method='abcd')
 
+    # invalid gradient direction
+    with pytest.raises(ValueError):
+        marching_cubes(ellipsoid_isotropic, 0.0, gradient_direction='abcd')
+
+    # invalid backend, or backend that does not support the method
+    with pytest.raises(ValueError):
+        marching_cubes(ellipsoid_isotropic, 0.0, backend='abcd')
+    with pytest.raises(ValueError):
+        marching_cubes(ellipsoid_isotropic, 0.0, method='lewiner', backend='cuda')
+
 
 def test_both_algs_same_result_ellipse():
     # Performing this test on data that does not have ambiguities
@@ -168,6 +185,17 @@ def test_masked_marching_cubes():
     assert_allclose(area, 299.56878662109375, rtol=0.01)
 
 
+def test_masked_marching_cubes_read_only():
+    ellipsoid_scalar = ellipsoid(6, 10, 16, levelset=True)
+    mask = np.ones_like(ellipsoid_scalar, dtype=bool)
+    mask[:10, :, :] = False
+    expected = marching_cubes(ellipsoid_scalar, 0, mask=mask)
+    mask.flags.writeable = False
+    result = marching_cubes(ellipsoid_scalar, 0, mask=mask)
+    for res, exp in zip(result, expected):
+        np.testing.assert_array_equal(res, exp)
+
+
 def test_masked_marching_cubes_empty():
     ellipsoid_scalar = ellipsoid(6, 10, 16, levelset=True)
     mask = np.array([])
@@ -182,3 +210,150 @@ def test_masked_marching_cubes_all_true():
     ver, faces, _, _ = marching_cubes(ellipsoid_scalar, 0, mask=mask)
     assert_allclose(ver_m, ver, rtol=0.00001)
     assert_allclose(faces_m, faces, rtol=0.00001)
+
+
+def test_precomputed_luts():
+    # The decoded luts must stay in sync with their base64 definitions
+    luts = _load_mc_luts()
+    assert len(luts) == 48
+    for name, lut in luts.items():
+        shape, text = getattr(mcluts, name)
+        expected = np.frombuffer(base64.decodebytes(text.encode('utf-8')), 'int8')
+        assert lut.dtype == np.int8
+        assert lut.shape == shape
+        np.testing.assert_array_equal(lut.ravel(), expected)
+
+
+@pytest.mark.parametrize('level', [None, 0.5])
+def test_marching_cubes_float64(level):
+    # float64 data is processed without a copy, with the same result as for
+    # the volume cast to float32
+    rng = np.random.default_rng(0)
+    volume = 0.5 + rng.uniform(-1e-7, 1e-7, (15, 17, 19))
+    assert volume.dtype == np.float64
+    expected = marching_cubes(volume.astype(np.float32), level)
+    result = marching_cubes(volume, level)
+    for res, exp in zip(result, expected):
+        np.testing.assert_array_equal(res, exp)
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+def test_marching_cubes_read_only(dtype):
+    # Read-only volumes, e.g. memory-mapped ones, are read without a copy
+    volume = ellipsoid(6, 10, 16, levelset=True).astype(dtype)
+    expected = marching_cubes(volume, 0)
+    volume.flags.writeable = False
+    result = marching_cubes(volume, 0)
+    for res, exp in zip(result, expected):
+        np.testing.assert_array_equal(res, exp)
+
+
+@pytest.mark.parametrize('method', ['lewiner', 'lorensen'])
+@pytest.mark.parametrize('spacing', [(1.0, 1.0, 1.0), (0.5, 1.5, 2.0)])
+def test_marching_cubes_verts_dtype(method, spacing):
+    # The vertices are float32 for any spacing, scaled before rounding
+    ellipsoid_scalar = ellipsoid(6, 10, 16, levelset=True)
+    verts = marching_cubes(ellipsoid_scalar, 0, spacing=spacing, method=method)[0]
+    unit = marching_cubes(ellipsoid_scalar, 0, method=method)[0]
+    assert verts.dtype == np.float32
+    np.testing.assert_array_equal(
+        verts, (unit.astype(np.float64) * spacing).astype(np.float32)
+    )
+
+
+@pytest.mark.parametrize('method', ['lewiner', 'lorensen'])
+@pytest.mark.parametrize('num_threads', [2, 3, 100])
+def test_marching_cubes_num_threads(method, num_threads):
+    # The slabs of the volume are merged into the same mesh as without slabs
+    rng = np.random.default_rng(0)
+    volume = rng.random((23, 17, 19))
+    mask = rng.random(volume.shape) > 0.3
+    expected = marching_cubes(volume, 0.5, method=method, mask=mask, num_threads=1)
+    result = marching_cubes(
+        volume, 0.5, method=method, mask=mask, num_threads=num_threads
+    )
+    np.testing.assert_array_equal(result[0], expected[0])
+    np.testing.assert_array_equal(result[1], expected[1])
+    assert_allclose(result[2], expected[2], atol=1e-6)
+    np.testing.assert_array_equal(result[3], expected[3])
+
+
+@pytest.mark.parametrize('step_size', [1, 2, 3])
+def test_masked_marching_cubes_bounding_box(step_size):
+    # Only the bounding box of the mask is visited, which must not change
+    # the result compared to visiting the whole volume
+    ellipsoid_scalar = ellipsoid(6, 10, 16, levelset=True)
+    mask = np.zeros_like(ellipsoid_scalar, dtype=bool)
+    mask[5:11, 3:17, 9:30] = True
+    expected_mask = mask.copy()
+    # Set elements away from the surface, so that no cells are skipped
+    expected_mask[0, 0, 0] = expected_mask[-1, -1, -1] = True
+    result = marching_cubes(ellipsoid_scalar, 0, step_size=step_size, mask=mask)
+    expected = marching_cubes(
+        ellipsoid_scalar, 0, step_size=step_size, mask=expected_mask
+    )
+    for res, exp in zip(result, expected):
+        np.testing.assert_array_equal(res, exp)
+
+
+@pytest.mark.parametrize('step_size', [1, 2])
+@pytest.mark.parametrize('gradient_direction', ['descent', 'ascent'])
+def test_marching_cubes_cuda(step_size, gradient_direction):
+    pytest.importorskip('cupy')
+    ellipsoid_scalar = ellipsoid(6, 10, 16, levelset=True)
+    mask = np.ones_like(ellipsoid_scalar, dtype=bool)
+    mask[:10, :, :] = False
+    kwargs = dict(
+        method='lorensen',
+        step_size=step_size,
+        gradient_direction=gradient_direction,
+        spacing=(0.5, 1.5, 2.0),
+        mask=mask,
+    )
+    expected = marching_cubes(ellipsoid_scalar, 0, **kwargs)
+    result = marching_cubes(ellipsoid_scalar, 0, backend='cuda', **kwargs)
+    np.testing.assert_array_equal(result[0], expected[0])
+    np.testing.assert_array_equal(result[1], expected[1])
+    assert_allclose(result[2], expected[2], atol=1e-6)
+    np.testing.assert_array_equal(result[3], expected[3])
+
+
+@pytest.mark.parametrize('dtype', [bool, np.uint8, np.int8, np.uint16, np.int16])
+def test_marching_cubes_small_int(dtype):
+    # Small integer and boolean volumes are read directly, with the same
+    # result as for the volume cast to float32
+    ellipsoid_scalar = ellipsoid(6, 10, 16, levelset=True)
+    if dtype is bool:
+        volume = ellipsoid_scalar < 0
+    else:
+        volume = (ellipsoid_scalar * 100).astype(dtype)
+    expected = marching_cubes(volume.astype(np.float32))
+    result = marching_cubes(volume)
+    for res, exp in zip(result, expected):
+        np.testing.assert_array_equal(res, exp)
+    # Also for read-only volumes, which are not copied
+    volume.flags.writeable = False
+    result = marching_cubes(volume)
+    for res, exp in zip(result, expected):
+        np.testing.assert_array_equal(res, exp)
+
+
+def test_marching_cubes_unchecked():
+    # The unchecked function gives the same result for valid inputs
+    ellipsoid_scalar = ellipsoid(6, 10, 16, levelset=True).astype(np.float32)
+    expected = marching_cubes(ellipsoid_scalar, 0.0, spacing=(1.0, 2.0, 3.0))
+    result = _marching_cubes_unchecked(
+        ellipsoid_scalar,
+        0.0,
+        spacing=(1.0, 2.0, 3.0),
+        descent=True,
+        step_size=1,
+        allow_degenerate=True,
+        use_classic=False,
+        mask=None,
+        single_mesh=False,
+        num_threads=0,
+        backend='cpu',
+    )
+    for res, exp in zip(result, expected):
+        np.testing.assert_array_equal(res, exp)
@@ -0,0 +1,51 @@
+"""Utility script that was used to decode the lookup tables of the Lewiner
+marching cubes algorithm into a binary file.
+
+The lookup tables are defined as base64 encoded text in
+    skimage/measure/_marching_cubes_lewiner_luts.py
+which is itself generated from `mc_meta/LookUpTable.h` by
+`mc_meta/createluts.py`. Decoding them on first use of `marching_cubes` is
+comparatively expensive, so the decoded tables are stored in
+    skimage/measure/_marching_cubes_lewiner_luts.npz
+as a single int8 array `data` with the tables back to back, together with
+their `names` and `shapes` (padded with zeros to three dimensions).
+
+Run this script from the repository root after regenerating the Python luts.
+"""
+
+import base64
+import os
+
+import numpy as np
+
+from skimage.measure import _marching_cubes_lewiner_luts as mcluts
+
+
+def _to_array(args):
+    shape, text = args
+    byts = base64.decodebytes(text.encode('utf-8'))
+    ar = np.frombuffer(byts, dtype='int8')
+    ar.shape = shape
+    return ar
+
+
+def precompute_luts():
+    names = [
+        name
+        for name in dir(mcluts)
+        if name.isupper() and isinstance(getattr(mcluts, name), tuple)
+    ]
+    arrays = [_to_array(getattr(mcluts, name)) for name in names]
+    shapes = np.zeros((len(arrays), 3), dtype=np.int64)
+    for i, ar in enumerate(arrays):
+        shapes[i, : ar.ndim] = ar.shape
+    return {
+        'data': np.concatenate([ar.ravel() for ar in arrays]),
+        'names': np.array(names),
+        'shapes': shapes,
+    }
+
+
+if __name__ == "__main__":
+    fname = os.path.join('skimage', 'measure', '_marching_cubes_lewiner_luts.npz')
+    np.savez(fname, **precompute_luts())